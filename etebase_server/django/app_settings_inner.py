@@ -13,6 +13,7 @@
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 import typing as t
 
+from django.core.signals import setting_changed
 from django.utils.functional import cached_property
 
 
@@ -33,6 +34,12 @@ class AppSettings:
 
         return getattr(settings, self.prefix + name, dflt)
 
+    def reload(self):
+        """Drop the cached values so they are resolved again on next access"""
+        for name, value in vars(type(self)).items():
+            if isinstance(value, cached_property):
+                self.__dict__.pop(name, None)
+
     @cached_property
     def REDIS_URI(self) -> t.Optional[str]:  # pylint: disable=invalid-name
         return self._setting("REDIS_URI", None)
@@ -85,5 +92,25 @@ class AppSettings:
     def CHALLENGE_VALID_SECONDS(self):  # pylint: disable=invalid-name
         return self._setting("CHALLENGE_VALID_SECONDS", 60)
 
+    @cached_property
+    def LOGIN_CHALLENGE_CACHE_SECONDS(self):  # pylint: disable=invalid-name
+        """How long to cache the user data needed for login challenges, 0 (the default) to disable
+
+        Needs a cache shared by all of the server processes, changes are only invalidated in the one making them.
+        """
+        return self._setting("LOGIN_CHALLENGE_CACHE_SECONDS", 0)
+
+    @cached_property
+    def BULK_BATCH_SIZE(self):  # pylint: disable=invalid-name
+        return self._setting("BULK_BATCH_SIZE", 500)
+
 
 app_settings = AppSettings("ETEBASE_")
+
+
+def reload_app_settings(*, setting: str, **kwargs):
+    if setting.startswith(app_settings.prefix):
+        app_settings.reload()
+
+
+setting_changed.connect(reload_app_settings)
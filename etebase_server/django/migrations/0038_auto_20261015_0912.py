@@ -0,0 +1,30 @@
+# Generated by Django 3.2.25 on 2026-10-15 09:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("django_etebase", "0037_auto_20210127_1237"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="collectionitemrevision",
+            name="current",
+            field=models.BooleanField(default=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name="collectionitemrevision",
+            index=models.Index(
+                condition=models.Q(("current", True)),
+                fields=["item", "current"],
+                name="etebase_revision_current_idx",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="collectionmember",
+            index=models.Index(fields=["collection", "user", "accessLevel"], name="etebase_member_access_idx"),
+        ),
+    ]
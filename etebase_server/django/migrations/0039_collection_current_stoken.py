@@ -0,0 +1,47 @@
+# Generated by Django 3.2.25 on 2026-10-15 10:03
+
+from django.db import migrations, models
+from django.db.models import IntegerField, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce, Greatest, NullIf
+import django.db.models.deletion
+
+
+def set_current_stoken(apps, schema_editor):
+    Collection = apps.get_model("django_etebase", "Collection")
+    CollectionItemRevision = apps.get_model("django_etebase", "CollectionItemRevision")
+    CollectionMember = apps.get_model("django_etebase", "CollectionMember")
+
+    # Backfill all of the collections in a single statement rather than querying each one
+    revisions_max = CollectionItemRevision.objects.filter(item__collection_id=OuterRef("pk"), current=True).order_by(
+        "-stoken_id"
+    )
+    # Legacy members may have no stoken, exclude them as NULLs sort first when descending on some databases
+    members_max = CollectionMember.objects.filter(collection_id=OuterRef("pk"), stoken__isnull=False).order_by(
+        "-stoken_id"
+    )
+    stoken_ids = [
+        Coalesce(Subquery(queryset.values("stoken_id")[:1]), Value(0), output_field=IntegerField())
+        for queryset in (revisions_max, members_max)
+    ]
+    Collection.objects.update(current_stoken_id=NullIf(Greatest(*stoken_ids), Value(0)))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("django_etebase", "0038_auto_20261015_0912"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="collection",
+            name="current_stoken",
+            field=models.ForeignKey(
+                null=True,
+                on_delete=django.db.models.deletion.SET_NULL,
+                related_name="+",
+                to="django_etebase.stoken",
+            ),
+        ),
+        migrations.RunPython(set_current_stoken, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.2.25 on 2026-10-15 10:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("django_etebase", "0039_collection_current_stoken"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="collectiontype",
+            name="uid",
+            field=models.BinaryField(editable=True, max_length=1024, unique=True),
+        ),
+    ]
@@ -0,0 +1,43 @@
+# Generated by Django 3.2.25 on 2026-10-15 13:40
+
+from django.db import migrations, models
+
+
+def null_to_false(apps, schema_editor):
+    CollectionItemRevision = apps.get_model("django_etebase", "CollectionItemRevision")
+    CollectionItemRevision.objects.filter(current__isnull=True).update(current=False)
+
+
+def false_to_null(apps, schema_editor):
+    CollectionItemRevision = apps.get_model("django_etebase", "CollectionItemRevision")
+    CollectionItemRevision.objects.filter(current=False).update(current=None)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("django_etebase", "0040_alter_collectiontype_uid"),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name="collectionitemrevision",
+            name="etebase_revision_current_idx",
+        ),
+        migrations.AlterUniqueTogether(
+            name="collectionitemrevision",
+            unique_together=set(),
+        ),
+        migrations.RunPython(null_to_false, false_to_null),
+        migrations.AlterField(
+            model_name="collectionitemrevision",
+            name="current",
+            field=models.BooleanField(default=True),
+        ),
+        migrations.AddConstraint(
+            model_name="collectionitemrevision",
+            constraint=models.UniqueConstraint(
+                condition=models.Q(("current", True)), fields=("item",), name="etebase_revision_one_current"
+            ),
+        ),
+    ]
@@ -12,16 +12,18 @@
 # You should have received a copy of the GNU General Public License
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 
+import base64
+import os
 import typing as t
-from pathlib import Path
 
 from django.db import models, transaction
 from django.conf import settings
+from django.core.cache import cache
 from django.core.validators import RegexValidator
-from django.db.models import Max, Value as V
+from django.db.models import Max, Q, Value as V
 from django.db.models.functions import Coalesce, Greatest
+from django.db.models.signals import post_delete, post_save
 from django.utils.functional import cached_property
-from django.utils.crypto import get_random_string
 
 from . import app_settings
 
@@ -29,6 +31,20 @@ from . import app_settings
 UidValidator = RegexValidator(regex=r"^[a-zA-Z0-9\-_]{20,}$", message="Not a valid UID")
 
 
+M = t.TypeVar("M", bound=models.Model)
+
+
+def bulk_create_with_pks(model: t.Type[M], objs: t.List[M], unique_field: str) -> t.List[M]:
+    """Like bulk_create, but makes sure the primary keys of the returned objects are set"""
+    objs = model._default_manager.bulk_create(objs, batch_size=app_settings.BULK_BATCH_SIZE)
+    if any(obj.pk is None for obj in objs):
+        # Not all database backends return the ids of bulk created rows, so fetch them using a unique field
+        keys = [getattr(obj, unique_field) for obj in objs]
+        objs_by_key = model._default_manager.in_bulk(keys, field_name=unique_field)
+        objs = [objs_by_key[getattr(obj, unique_field)] for obj in objs]
+    return objs
+
+
 def stoken_annotation_builder(stoken_id_fields: t.List[str]):
     aggr_fields = [Coalesce(Max(field), V(0)) for field in stoken_id_fields]
     return Greatest(*aggr_fields) if len(aggr_fields) > 1 else aggr_fields[0]
@@ -36,46 +52,85 @@ def stoken_annotation_builder(stoken_id_fields: t.List[str]):
 
 class CollectionType(models.Model):
     owner = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
-    uid = models.BinaryField(editable=True, blank=False, null=False, db_index=True, unique=True, max_length=1024)
+    uid = models.BinaryField(editable=True, blank=False, null=False, unique=True, max_length=1024)
 
     objects: models.manager.BaseManager["CollectionType"]
 
 
+class CollectionQuerySet(models.QuerySet):
+    def with_access_for(self, user) -> "CollectionQuerySet":
+        """Annotate the access level of user (or None if not a member) as user_access_level"""
+        members = CollectionMember.objects.filter(collection=models.OuterRef("pk"), user=user)
+        return self.annotate(user_access_level=models.Subquery(members.values("accessLevel")[:1]))
+
+
+CollectionManager = models.Manager.from_queryset(CollectionQuerySet)
+
+
 class Collection(models.Model):
     main_item = models.OneToOneField("CollectionItem", related_name="parent", null=True, on_delete=models.SET_NULL)
     # The same as main_item.uid, we just also save it here so we have DB constraints for uniqueness (and efficiency)
     uid = models.CharField(db_index=True, unique=True, blank=False, max_length=43, validators=[UidValidator])
     owner = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
+    # The latest stoken of the items and members, we save it here so we don't need to calculate it on every access
+    current_stoken = models.ForeignKey("Stoken", related_name="+", null=True, on_delete=models.SET_NULL)
 
-    stoken_annotation = stoken_annotation_builder(["items__revisions__stoken", "members__stoken"])
+    # current_stoken already holds the max stoken of the items and members, so there's no need to join and aggregate
+    stoken_annotation = Coalesce("current_stoken", V(0), output_field=models.IntegerField())
 
-    objects: models.manager.BaseManager["Collection"]
+    objects = CollectionManager()
 
     def __str__(self):
         return self.uid
 
-    @property
+    @cached_property
     def content(self) -> "CollectionItemRevision":
         assert self.main_item is not None
         return self.main_item.content
 
-    @property
+    @cached_property
     def etag(self) -> str:
         return self.content.uid
 
-    @cached_property
+    @property
     def stoken(self) -> str:
-        stoken_id = (
-            self.__class__.objects.filter(main_item=self.main_item, items__revisions__current=True)
-            .annotate(max_stoken=self.stoken_annotation)
-            .values("max_stoken")
-            .first()["max_stoken"]
-        )
-
-        if stoken_id == 0:
+        if self.current_stoken is None:
             raise Exception("stoken is None. Should never happen")
 
-        return Stoken.objects.get(id=stoken_id).uid
+        return self.current_stoken.uid
+
+    @classmethod
+    def calculate_stoken_id(cls, collection_id: int) -> int:
+        # Query each relation on its own rather than joining both, each is then a single LIMIT 1 index scan
+        querysets = [
+            CollectionItemRevision.objects.filter(item__collection_id=collection_id, current=True),
+            # Legacy members may have no stoken, and NULLs sort first when descending on some databases
+            CollectionMember.objects.filter(collection_id=collection_id, stoken__isnull=False),
+        ]
+        stoken_ids = [
+            stoken_id
+            for queryset in querysets
+            for stoken_id in queryset.order_by("-stoken_id").values_list("stoken_id", flat=True)[:1]
+        ]
+        return max(stoken_ids, default=0)
+
+    @classmethod
+    def advance_stoken(cls, collection_id: int, stoken: "Stoken"):
+        """Set a newly created stoken as the current one, called whenever items or members are added or changed"""
+        # Only move forward, a concurrent transaction may have already set a newer stoken
+        cls.objects.filter(Q(current_stoken__isnull=True) | Q(current_stoken__lt=stoken.id), pk=collection_id).update(
+            current_stoken=stoken
+        )
+
+    @classmethod
+    def recalculate_stoken(cls, collection_id: int):
+        """Recalculate the current stoken from scratch, needed when members are removed"""
+        with transaction.atomic():
+            # Lock the collection like item batches do, otherwise a concurrent advance_stoken could commit a newer
+            # stoken after we calculated ours, and we'd then move the stoken backwards.
+            list(cls.objects.select_for_update().filter(pk=collection_id).values_list("pk", flat=True))
+            stoken_id = cls.calculate_stoken_id(collection_id)
+            cls.objects.filter(pk=collection_id).update(current_stoken_id=stoken_id or None)
 
 
 class CollectionItem(models.Model):
@@ -96,23 +151,43 @@ class CollectionItem(models.Model):
 
     @cached_property
     def content(self) -> "CollectionItemRevision":
+        current_revisions = getattr(self, "_current_revisions", None)
+        if current_revisions is not None:
+            return current_revisions[0]
         return self.revisions.filter(current=True)[0]
 
-    @property
+    @cached_property
     def etag(self) -> str:
         return self.content.uid
 
 
-def chunk_directory_path(instance: "CollectionItemChunk", filename: str) -> Path:
+def prefetch_chunks(lookup: str = "chunks_relation") -> models.Prefetch:
+    """Prefetch the chunk relations of revisions together with their chunks"""
+    return models.Prefetch(lookup, queryset=RevisionChunkRelation.objects.select_related("chunk"))
+
+
+def prefetch_current_revisions(lookup: str = "revisions") -> models.Prefetch:
+    """Prefetch the current revisions of items so that CollectionItem.content doesn't need to query them"""
+    queryset = CollectionItemRevision.objects.filter(current=True).prefetch_related(prefetch_chunks())
+    return models.Prefetch(lookup, queryset=queryset, to_attr="_current_revisions")
+
+
+def prefetch_user_member(user, lookup: str = "members") -> models.Prefetch:
+    """Prefetch the membership of user in collections, so the collection output doesn't need to query it"""
+    queryset = CollectionMember.objects.filter(user=user).select_related("collectionType")
+    return models.Prefetch(lookup, queryset=queryset, to_attr="_user_member")
+
+
+def chunk_directory_path(instance: "CollectionItemChunk", filename: str) -> str:
     custom_func = app_settings.CHUNK_PATH_FUNC
     if custom_func is not None:
         return custom_func(instance, filename)
 
     col: Collection = instance.collection
-    user_id: int = col.owner.id
+    user_id: int = col.owner_id
     uid_prefix: str = instance.uid[:2]
     uid_rest: str = instance.uid[2:]
-    return Path("user_{}".format(user_id), col.uid, uid_prefix, uid_rest)
+    return f"user_{user_id}/{col.uid}/{uid_prefix}/{uid_rest}"
 
 
 class CollectionItemChunk(models.Model):
@@ -130,7 +205,8 @@ class CollectionItemChunk(models.Model):
 
 
 def generate_stoken_uid():
-    return get_random_string(32, allowed_chars="abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789-_")
+    # 24 random bytes encode to exactly 32 url-safe base64 characters (no padding)
+    return base64.urlsafe_b64encode(os.urandom(24)).decode("ascii")
 
 
 class Stoken(models.Model):
@@ -147,6 +223,10 @@ class Stoken(models.Model):
 
     objects: models.manager.BaseManager["Stoken"]
 
+    @classmethod
+    def create_many(cls, count: int) -> t.List["Stoken"]:
+        return bulk_create_with_pks(cls, [cls() for _ in range(count)], "uid")
+
 
 class CollectionItemRevision(models.Model):
     stoken = models.OneToOneField(Stoken, on_delete=models.PROTECT)
@@ -155,17 +235,37 @@ class CollectionItemRevision(models.Model):
     )
     item = models.ForeignKey(CollectionItem, related_name="revisions", on_delete=models.CASCADE)
     meta = models.BinaryField(editable=True, blank=False, null=False)
-    current = models.BooleanField(db_index=True, default=True, null=True)
+    current = models.BooleanField(default=True)
     deleted = models.BooleanField(default=False)
 
     objects: models.manager.BaseManager["CollectionItemRevision"]
 
     class Meta:
-        unique_together = ("item", "current")
+        constraints = [
+            # Only one current revision per item. Being partial, it also serves as the index for current lookups
+            models.UniqueConstraint(fields=["item"], condition=Q(current=True), name="etebase_revision_one_current"),
+        ]
 
     def __str__(self):
         return "{} {} current={}".format(self.uid, self.item.uid, self.current)
 
+    @classmethod
+    def bulk_create_with_stokens(cls, revisions: t.List["CollectionItemRevision"]) -> t.List["CollectionItemRevision"]:
+        """Create revisions in bulk, each with a new stoken, and advance the stokens of their collections"""
+        stokens = Stoken.create_many(len(revisions))
+        latest_stokens: t.Dict[int, Stoken] = {}
+        for revision, stoken in zip(revisions, stokens):
+            revision.stoken = stoken
+            collection_id = revision.item.collection_id
+            if collection_id not in latest_stokens or latest_stokens[collection_id].id < stoken.id:
+                latest_stokens[collection_id] = stoken
+
+        revisions = bulk_create_with_pks(cls, revisions, "uid")
+
+        for collection_id, stoken in latest_stokens.items():
+            Collection.advance_stoken(collection_id, stoken)
+        return revisions
+
 
 class RevisionChunkRelation(models.Model):
     chunk = models.ForeignKey(CollectionItemChunk, related_name="revisions_relation", on_delete=models.CASCADE)
@@ -200,21 +300,44 @@ class CollectionMember(models.Model):
 
     class Meta:
         unique_together = ("user", "collection")
+        indexes = [
+            # Covers the access level lookups done for permission checks
+            models.Index(fields=["collection", "user", "accessLevel"], name="etebase_member_access_idx"),
+        ]
 
     def __str__(self):
         return "{} {}".format(self.collection.uid, self.user)
 
     def revoke(self):
+        self.revoke_many([self])
+
+    @classmethod
+    def revoke_many(cls, members: t.List["CollectionMember"]):
+        if len(members) == 0:
+            return
+
         with transaction.atomic():
-            CollectionMemberRemoved.objects.update_or_create(
-                collection=self.collection,
-                user=self.user,
-                defaults={
-                    "stoken": Stoken.objects.create(),
-                },
+            stokens = Stoken.create_many(len(members))
+
+            # Replace existing records rather than update_or_create each one. Nothing references them, so the delete is
+            # a single query, and Django < 4.1 doesn't support upserting with bulk_create.
+            existing = Q()
+            for member in members:
+                existing |= Q(collection_id=member.collection_id, user_id=member.user_id)
+            CollectionMemberRemoved.objects.filter(existing).delete()
+            CollectionMemberRemoved.objects.bulk_create(
+                [
+                    CollectionMemberRemoved(collection_id=member.collection_id, user_id=member.user_id, stoken=stoken)
+                    for member, stoken in zip(members, stokens)
+                ],
+                batch_size=app_settings.BULK_BATCH_SIZE,
             )
 
-            self.delete()
+            cls.objects.filter(pk__in=[member.pk for member in members]).delete()
+
+            # Sorted so concurrent revocations lock the collections in the same order
+            for collection_id in sorted({member.collection_id for member in members}):
+                Collection.recalculate_stoken(collection_id)
 
 
 class CollectionMemberRemoved(models.Model):
@@ -270,3 +393,27 @@ class UserInfo(models.Model):
 
     def __str__(self):
         return "UserInfo<{}>".format(self.owner)
+
+
+def login_challenge_cache_key(user_id) -> str:
+    return f"etebase:login_challenge:{user_id}"
+
+
+# The user and userinfo fields the cached login challenge data depends on, other updates (e.g. of last_login on every
+# login) shouldn't evict it.
+LOGIN_CHALLENGE_CACHED_FIELDS = frozenset(("username", "email", "is_active", "salt", "version", "loginPubkey"))
+
+
+def invalidate_login_challenge_cache(sender, instance: models.Model, update_fields=None, **kwargs):
+    if not app_settings.LOGIN_CHALLENGE_CACHE_SECONDS:
+        return
+    if update_fields is not None and LOGIN_CHALLENGE_CACHED_FIELDS.isdisjoint(update_fields):
+        return
+    # Both users and their userinfo are keyed by the user id
+    cache.delete(login_challenge_cache_key(instance.pk))
+
+
+post_save.connect(invalidate_login_challenge_cache, sender=settings.AUTH_USER_MODEL)
+post_delete.connect(invalidate_login_challenge_cache, sender=settings.AUTH_USER_MODEL)
+post_save.connect(invalidate_login_challenge_cache, sender=UserInfo)
+post_delete.connect(invalidate_login_challenge_cache, sender=UserInfo)
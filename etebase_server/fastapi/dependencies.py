@@ -36,10 +36,10 @@ def __renew_token(auth_token: AuthToken):
         auth_token.save(update_fields=("expiry",))
 
 
-def __get_authenticated_user(api_token: str):
+def __get_authenticated_user(api_token: str, *related: str):
     api_token = api_token.split()[1]
     try:
-        token: AuthToken = AuthToken.objects.select_related("user").get(key=api_token)
+        token: AuthToken = AuthToken.objects.select_related("user", *related).get(key=api_token)
     except AuthToken.DoesNotExist:
         raise AuthenticationFailed(detail="Invalid token.")
     if not token.user.is_active:
@@ -68,6 +68,13 @@ def get_authenticated_user(api_token: str = Depends(token_scheme)) -> UserType:
     return user
 
 
+@django_db_cleanup_decorator
+def get_authenticated_user_with_userinfo(api_token: str = Depends(token_scheme)) -> UserType:
+    # Same as get_authenticated_user, but also fetches the userinfo in the same query
+    user, _ = __get_authenticated_user(api_token, "user__userinfo")
+    return user
+
+
 @django_db_cleanup_decorator
 def get_collection_queryset(user: UserType = Depends(get_authenticated_user)) -> QuerySet:
     default_queryset: QuerySet = models.Collection.objects.all()
@@ -75,7 +82,13 @@ def get_collection_queryset(user: UserType = Depends(get_authenticated_user)) ->
 
 
 @django_db_cleanup_decorator
-def get_collection(collection_uid: str, queryset: QuerySet = Depends(get_collection_queryset)) -> models.Collection:
+def get_collection(
+    collection_uid: str,
+    queryset: models.CollectionQuerySet = Depends(get_collection_queryset),
+    user: UserType = Depends(get_authenticated_user),
+) -> models.Collection:
+    # Annotate the user's access level so permission checks don't need an extra query for the membership
+    queryset = queryset.select_related("main_item", "current_stoken").with_access_for(user)
     return get_object_or_404(queryset, uid=collection_uid)
 
 
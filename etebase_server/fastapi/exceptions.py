@@ -118,7 +118,7 @@ def flatten_errors(field_name: str, errors) -> t.List[HttpError]:
     return ret
 
 
-def transform_validation_error(prefix: str, err: DjangoValidationError):
+def transform_validation_error(prefix: str, err: DjangoValidationError) -> t.NoReturn:
     if hasattr(err, "error_dict"):
         errors = flatten_errors(prefix, err.error_dict)
     elif not hasattr(err, "message"):
@@ -39,15 +39,26 @@ class MsgpackRoute(APIRoute):
 
     def __init__(self, path: str, endpoint: t.Callable[..., t.Any], *args, **kwargs):
         endpoint = django_db_cleanup_decorator(endpoint)
+        # Route handlers by registered media type (None for the default), so we don't create one on every request
+        self._route_handlers: t.Dict[t.Optional[str], t.Callable] = {}
         super().__init__(path, endpoint, *args, **kwargs)
 
     def _get_media_type_route_handler(self, media_type):
+        if media_type not in self.ROUTES_HANDLERS_CLASSES:
+            media_type = None
+        route_handler = self._route_handlers.get(media_type)
+        if route_handler is None:
+            route_handler = self._route_handlers[media_type] = self._create_route_handler(media_type)
+        return route_handler
+
+    def _create_route_handler(self, media_type):
+        # use custom response class or fallback on default self.response_class
+        response_class = self.ROUTES_HANDLERS_CLASSES.get(media_type, self.response_class)
         return get_request_handler(
             dependant=self.dependant,
             body_field=self.body_field,
             status_code=self.status_code,
-            # use custom response class or fallback on default self.response_class
-            response_class=self.ROUTES_HANDLERS_CLASSES.get(media_type, self.response_class),
+            response_class=response_class,
             response_field=self.secure_cloned_response_field,
             response_model_include=self.response_model_include,
             response_model_exclude=self.response_model_exclude,
@@ -1,18 +1,24 @@
+import functools
+import hashlib
+import hmac
+import os
+import time
 import typing as t
 from typing_extensions import Literal
-from datetime import datetime
 
 import nacl
+import nacl.bindings
 import nacl.encoding
+import nacl.exceptions
 import nacl.hash
-import nacl.secret
-import nacl.signing
 from django.conf import settings
 from django.contrib.auth import user_logged_out, user_logged_in
 from django.core import exceptions as django_exceptions
+from django.core.cache import cache
 from django.db import transaction
+from django.dispatch import Signal
 from django.utils.functional import cached_property
-from fastapi import APIRouter, Depends, status, Request
+from fastapi import APIRouter, BackgroundTasks, Depends, status, Request
 
 from etebase_server.django import app_settings, models
 from etebase_server.django.token_auth.models import AuthToken
@@ -21,9 +27,10 @@ from etebase_server.django.signals import user_signed_up
 from etebase_server.django.utils import create_user, get_user_queryset, CallbackContext
 from etebase_server.myauth.models import UserType, get_typed_user_model
 from ..exceptions import AuthenticationFailed, transform_validation_error, HttpError
+from ..db_hack import django_db_cleanup_decorator
 from ..msgpack import MsgpackRoute
 from ..utils import BaseModel, permission_responses, msgpack_encode, msgpack_decode, get_user_username_email_kwargs
-from ..dependencies import AuthData, get_auth_data, get_authenticated_user
+from ..dependencies import AuthData, get_auth_data, get_authenticated_user, get_authenticated_user_with_userinfo
 
 User = get_typed_user_model()
 authentication_router = APIRouter(route_class=MsgpackRoute)
@@ -117,7 +124,8 @@ def get_login_user(request: Request, challenge: LoginChallengeIn) -> UserType:
     kwargs = get_user_username_email_kwargs(username)
     try:
         user_queryset = get_user_queryset(User.objects.all(), CallbackContext(request.path_params))
-        user = user_queryset.get(**kwargs)
+        # Fetch the userinfo in the same query, it's needed for every login step (and the check below)
+        user = user_queryset.select_related("userinfo").get(**kwargs)
         if not hasattr(user, "userinfo"):
             raise AuthenticationFailed(code="user_not_init", detail="User not properly init")
         return user
@@ -125,17 +133,80 @@ def get_login_user(request: Request, challenge: LoginChallengeIn) -> UserType:
         raise AuthenticationFailed(code="user_not_found", detail="User not found")
 
 
-def get_encryption_key(salt: bytes):
-    key = nacl.hash.blake2b(settings.SECRET_KEY.encode(), encoder=nacl.encoding.RawEncoder)
+def hash_login_name(name: str) -> str:
+    # Hashed so usernames and emails don't end up in the cache as is
+    return hashlib.sha256(name.lower().encode()).hexdigest()
+
+
+def get_login_challenge_data(request: Request, challenge: LoginChallengeIn) -> t.Tuple[int, bytes, int]:
+    """Returns the user id, salt and version needed for a login challenge, cached to save the user lookup"""
+    timeout = app_settings.LOGIN_CHALLENGE_CACHE_SECONDS
+    if not timeout:
+        user = get_login_user(request, challenge)
+        return user.id, bytes(user.userinfo.salt), user.userinfo.version
+
+    name_hash = hash_login_name(challenge.username)
+    lookup = repr((name_hash, sorted(request.path_params.items())))
+    user_key = "etebase:login_user:" + hashlib.sha256(lookup.encode()).hexdigest()
+    user_id = cache.get(user_key)
+    if user_id is not None:
+        # The user data is dropped whenever the user or their userinfo change, and it's only used if the user is still
+        # known by this name, as the name to id mapping can't be invalidated on renames.
+        data = cache.get(models.login_challenge_cache_key(user_id))
+        if data is not None and name_hash in data[2]:
+            return user_id, data[0], data[1]
+
+    user = get_login_user(request, challenge)
+    salt, version = bytes(user.userinfo.salt), user.userinfo.version
+    names = frozenset(hash_login_name(name) for name in (getattr(user, User.USERNAME_FIELD), user.email) if name)
+    cache.set_many({user_key: user.id, models.login_challenge_cache_key(user.id): (salt, version, names)}, timeout)
+    return user.id, salt, version
+
+
+@functools.lru_cache(maxsize=4)
+def get_secret_key_hash(secret_key: str) -> bytes:
+    return nacl.hash.blake2b(secret_key.encode(), encoder=nacl.encoding.RawEncoder)
+
+
+# The key only depends on the server secret and the (per user) salt, so cache it rather than rederive it on every login.
+# The secret is part of the cache key so that a changed SECRET_KEY (e.g. overridden in tests) is picked up.
+@functools.lru_cache(maxsize=4096)
+def derive_encryption_key(secret_key: str, salt: bytes) -> bytes:
     return nacl.hash.blake2b(
         b"",
-        key=key,
+        key=get_secret_key_hash(secret_key),
         salt=salt[: nacl.hash.BLAKE2B_SALTBYTES],
         person=b"etebase-auth",
         encoder=nacl.encoding.RawEncoder,
     )
 
 
+def get_encryption_key(salt: bytes) -> bytes:
+    return derive_encryption_key(settings.SECRET_KEY, salt)
+
+
+# Use the secretbox bindings directly, skipping the SecretBox/EncryptedMessage wrappers. Same format: nonce + ciphertext
+def encrypt_challenge(salt: bytes, plaintext: bytes) -> bytes:
+    nonce = os.urandom(nacl.bindings.crypto_secretbox_NONCEBYTES)
+    return nonce + nacl.bindings.crypto_secretbox(plaintext, nonce, get_encryption_key(salt))
+
+
+def decrypt_challenge(salt: bytes, challenge: bytes) -> bytes:
+    nonce_size = nacl.bindings.crypto_secretbox_NONCEBYTES
+    return nacl.bindings.crypto_secretbox_open(challenge[nonce_size:], challenge[:nonce_size], get_encryption_key(salt))
+
+
+def verify_signature(pubkey: bytes, message: bytes, signature: bytes) -> bool:
+    # Like VerifyKey.verify() but without the wrapper objects. The bindings don't check the lengths, so we have to
+    if len(pubkey) != nacl.bindings.crypto_sign_PUBLICKEYBYTES or len(signature) != nacl.bindings.crypto_sign_BYTES:
+        return False
+    try:
+        nacl.bindings.crypto_sign_open(signature + message, pubkey)
+    except nacl.exceptions.BadSignatureError:
+        return False
+    return True
+
+
 def save_changed_password(data: ChangePassword, user: UserType):
     response_data = data.response_data
     user_info: UserInfo = user.userinfo
@@ -151,63 +222,69 @@ def validate_login_request(
     expected_action: str,
     host_from_request: str,
 ):
-    enc_key = get_encryption_key(bytes(user.userinfo.salt))
-    box = nacl.secret.SecretBox(enc_key)
-    challenge_data = msgpack_decode(box.decrypt(validated_data.challenge))
-    now = int(datetime.now().timestamp())
-    if validated_data.action != expected_action:
+    challenge_data = msgpack_decode(decrypt_challenge(bytes(user.userinfo.salt), validated_data.challenge))
+    now = int(time.time())
+    if not hmac.compare_digest(validated_data.action.encode(), expected_action.encode()):
         raise HttpError("wrong_action", f'Expected "{expected_action}" but got something else')
     elif now - challenge_data["timestamp"] > app_settings.CHALLENGE_VALID_SECONDS:
         raise HttpError("challenge_expired", "Login challenge has expired")
     elif challenge_data["userId"] != user.id:
         raise HttpError("wrong_user", "This challenge is for the wrong user")
-    elif not settings.DEBUG and validated_data.host.split(":", 1)[0] != host_from_request.split(":", 1)[0]:
+    elif not settings.DEBUG and not hmac.compare_digest(
+        validated_data.host.split(":", 1)[0].encode(), host_from_request.split(":", 1)[0].encode()
+    ):
         raise HttpError(
             "wrong_host", f'Found wrong host name. Got: "{validated_data.host}" expected: "{host_from_request}"'
         )
-    verify_key = nacl.signing.VerifyKey(bytes(user.userinfo.loginPubkey), encoder=nacl.encoding.RawEncoder)
-    try:
-        verify_key.verify(challenge_sent_to_user.response, challenge_sent_to_user.signature)
-    except nacl.exceptions.BadSignatureError:
+    if not verify_signature(
+        bytes(user.userinfo.loginPubkey), challenge_sent_to_user.response, challenge_sent_to_user.signature
+    ):
         raise HttpError("login_bad_signature", "Wrong password for user.", status.HTTP_401_UNAUTHORIZED)
 
 
+# Receivers (e.g. the last_login update) hit the db, so send these after the response instead of delaying it
+@django_db_cleanup_decorator
+def send_user_signal(signal: Signal, user: UserType):
+    signal.send(sender=user.__class__, request=None, user=user)
+
+
 @authentication_router.get("/is_etebase/")
 async def is_etebase():
     pass
 
 
 @authentication_router.post("/login_challenge/", response_model=LoginChallengeOut)
-def login_challenge(user: UserType = Depends(get_login_user)):
-    salt = bytes(user.userinfo.salt)
-    enc_key = get_encryption_key(salt)
-    box = nacl.secret.SecretBox(enc_key)
+def login_challenge(request: Request, data: LoginChallengeIn):
+    user_id, salt, version = get_login_challenge_data(request, data)
     challenge_data = {
-        "timestamp": int(datetime.now().timestamp()),
-        "userId": user.id,
+        "timestamp": int(time.time()),
+        "userId": user_id,
     }
-    challenge = bytes(box.encrypt(msgpack_encode(challenge_data), encoder=nacl.encoding.RawEncoder))
-    return LoginChallengeOut(salt=salt, challenge=challenge, version=user.userinfo.version)
+    challenge = encrypt_challenge(salt, msgpack_encode(challenge_data))
+    return LoginChallengeOut(salt=salt, challenge=challenge, version=version)
 
 
 @authentication_router.post("/login/", response_model=LoginOut)
-def login(data: Login, request: Request):
+def login(data: Login, request: Request, background_tasks: BackgroundTasks):
     user = get_login_user(request, LoginChallengeIn(username=data.response_data.username))
     host = request.headers.get("Host")
     validate_login_request(data.response_data, data, user, "login", host)
     ret = LoginOut.from_orm(user)
-    user_logged_in.send(sender=user.__class__, request=None, user=user)
+    background_tasks.add_task(send_user_signal, user_logged_in, user)
     return ret
 
 
 @authentication_router.post("/logout/", status_code=status.HTTP_204_NO_CONTENT, responses=permission_responses)
-def logout(auth_data: AuthData = Depends(get_auth_data)):
-    auth_data.token.delete()
-    user_logged_out.send(sender=auth_data.user.__class__, request=None, user=auth_data.user)
+def logout(background_tasks: BackgroundTasks, auth_data: AuthData = Depends(get_auth_data)):
+    # Tokens have no dependent rows, so a queryset delete lets Django skip the deletion collector
+    AuthToken.objects.filter(pk=auth_data.token.pk).delete()
+    background_tasks.add_task(send_user_signal, user_logged_out, auth_data.user)
 
 
 @authentication_router.post("/change_password/", status_code=status.HTTP_204_NO_CONTENT, responses=permission_responses)
-def change_password(data: ChangePassword, request: Request, user: UserType = Depends(get_authenticated_user)):
+def change_password(
+    data: ChangePassword, request: Request, user: UserType = Depends(get_authenticated_user_with_userinfo)
+):
     host = request.headers.get("Host")
     validate_login_request(data.response_data, data, user, "changePassword", host)
     save_changed_password(data, user)
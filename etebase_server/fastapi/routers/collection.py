@@ -4,10 +4,10 @@ from asgiref.sync import sync_to_async
 from django.core import exceptions as django_exceptions
 from django.core.files.base import ContentFile
 from django.db import transaction, IntegrityError
-from django.db.models import Q, QuerySet
+from django.db.models import Exists, OuterRef, Q, QuerySet
 from fastapi import APIRouter, Depends, status, Request, BackgroundTasks
 
-from etebase_server.django import models
+from etebase_server.django import app_settings, models
 from etebase_server.myauth.models import UserType
 from .authentication import get_authenticated_user
 from .websocket import get_ticket, TicketRequest, TicketOut
@@ -19,8 +19,10 @@ from ..utils import (
     Context,
     Prefetch,
     PrefetchQuery,
+    get_access_level,
     is_collection_admin,
     msgpack_encode,
+    paginate,
     BaseModel,
     permission_responses,
     PERMISSIONS_READ,
@@ -65,7 +67,7 @@ class CollectionItemRevisionInOut(BaseModel):
                     chunks.append((chunk_obj.uid, f.read()))
             else:
                 chunks.append((chunk_obj.uid, None))
-        return cls(uid=obj.uid, meta=bytes(obj.meta), deleted=obj.deleted, chunks=chunks)
+        return cls.construct(uid=obj.uid, meta=bytes(obj.meta), deleted=obj.deleted, chunks=chunks)
 
 
 class CollectionItemCommon(BaseModel):
@@ -75,6 +77,8 @@ class CollectionItemCommon(BaseModel):
     content: CollectionItemRevisionInOut
 
 
+# The from_orm_context() methods below use construct(), skipping validation, since the values come straight from the
+# database and the response is validated against the response model anyway.
 class CollectionItemOut(CollectionItemCommon):
     class Config:
         orm_mode = True
@@ -83,7 +87,7 @@ class CollectionItemOut(CollectionItemCommon):
     def from_orm_context(
         cls: t.Type["CollectionItemOut"], obj: models.CollectionItem, context: Context
     ) -> "CollectionItemOut":
-        return cls(
+        return cls.construct(
             uid=obj.uid,
             version=obj.version,
             encryptionKey=obj.encryptionKey,
@@ -108,10 +112,11 @@ class CollectionOut(CollectionCommon):
 
     @classmethod
     def from_orm_context(cls: t.Type["CollectionOut"], obj: models.Collection, context: Context) -> "CollectionOut":
-        member: models.CollectionMember = obj.members.get(user=context.user)
+        user_member = getattr(obj, "_user_member", None)
+        member: models.CollectionMember = user_member[0] if user_member else obj.members.get(user=context.user)
         collection_type = member.collectionType
         assert obj.main_item is not None
-        ret = cls(
+        ret = cls.construct(
             collectionType=collection_type and bytes(collection_type.uid),
             collectionKey=bytes(member.encryptionKey),
             accessLevel=member.accessLevel,
@@ -158,13 +163,12 @@ class ItemDepIn(BaseModel):
     uid: str
     etag: str
 
-    def validate_db(self):
-        item = models.CollectionItem.objects.get(uid=self.uid)
+    def validate_etag(self, cur_etag: t.Optional[str]):
         etag = self.etag
-        if item.etag != etag:
+        if cur_etag != etag:
             raise ValidationError(
                 "wrong_etag",
-                "Wrong etag. Expected {} got {}".format(item.etag, etag),
+                "Wrong etag. Expected {} got {}".format(cur_etag, etag),
                 status_code=status.HTTP_409_CONFLICT,
                 field=self.uid,
             )
@@ -174,12 +178,17 @@ class ItemBatchIn(BaseModel):
     items: t.List[CollectionItemIn]
     deps: t.Optional[t.List[ItemDepIn]]
 
-    def validate_db(self):
+    def validate_db(self, collection: models.Collection):
         if self.deps is not None:
+            # Fetch the current etags of all of the deps at once
+            revisions = models.CollectionItemRevision.objects.filter(
+                item__collection=collection, item__uid__in=[dep.uid for dep in self.deps], current=True
+            )
+            etags = dict(revisions.values_list("item__uid", "uid"))
             errors: t.List[HttpError] = []
             for dep in self.deps:
                 try:
-                    dep.validate_db()
+                    dep.validate_etag(etags.get(dep.uid))
                 except ValidationError as e:
                     errors.append(e)
             if len(errors) > 0:
@@ -207,8 +216,11 @@ def collection_list_common(
     limit: int,
     prefetch: Prefetch,
 ) -> CollectionListResponse:
+    queryset = queryset.select_related("main_item", "current_stoken").prefetch_related(
+        models.prefetch_current_revisions("main_item__revisions"), models.prefetch_user_member(user)
+    )
     result, new_stoken_obj, done = filter_by_stoken_and_limit(
-        stoken, limit, queryset.filter(items__revisions__current=True), models.Collection.stoken_annotation
+        stoken, limit, queryset.filter(main_item__isnull=False), models.Collection.stoken_annotation
     )
     new_stoken = new_stoken_obj and new_stoken_obj.uid
     context = Context(user, prefetch)
@@ -225,8 +237,8 @@ def collection_list_common(
             # can point to the most recent collection change rather than most recent removed membership.
             remed_qs = remed_qs.filter(stoken__id__lte=new_stoken_obj.id)
 
-        remed = remed_qs.values_list("collection__uid", flat=True)
-        if len(remed) > 0:
+        remed = list(remed_qs.values_list("collection__uid", flat=True))
+        if remed:
             ret.removedMemberships = [RemovedMembershipOut(uid=x) for x in remed]
 
     return ret
@@ -247,8 +259,7 @@ def verify_collection_admin(
 def has_write_access(
     collection: models.Collection = Depends(get_collection), user: UserType = Depends(get_authenticated_user)
 ):
-    member = collection.members.get(user=user)
-    if member.accessLevel == models.AccessLevels.READ_ONLY:
+    if get_access_level(collection, user) == models.AccessLevels.READ_ONLY:
         raise PermissionDenied("no_write_access", "You need write access to write to this collection")
 
 
@@ -270,9 +281,12 @@ def list_multi(
     prefetch: Prefetch = PrefetchQuery,
 ):
     # FIXME: Remove the isnull part once we attach collection types to all objects ("collection-type-migration")
-    queryset = queryset.filter(
-        Q(members__collectionType__uid__in=data.collectionTypes) | Q(members__collectionType__isnull=True)
+    user_members = models.CollectionMember.objects.filter(
+        Q(collectionType__uid__in=data.collectionTypes) | Q(collectionType__isnull=True),
+        collection=OuterRef("pk"),
+        user=user,
     )
+    queryset = queryset.filter(Exists(user_members))
 
     return collection_list_common(queryset, user, stoken, limit, prefetch)
 
@@ -288,7 +302,13 @@ def collection_list(
     return collection_list_common(queryset, user, stoken, limit, prefetch)
 
 
-def process_revisions_for_item(item: models.CollectionItem, revision_data: CollectionItemRevisionInOut):
+PendingRevision = t.Tuple[models.CollectionItemRevision, t.List[models.CollectionItemChunk]]
+
+
+def prepare_revision_for_item(
+    item: models.CollectionItem, revision_data: CollectionItemRevisionInOut
+) -> PendingRevision:
+    """Validate a new revision and store its new chunks, the revision itself is returned unsaved"""
     chunks_objs = []
 
     revision = models.CollectionItemRevision(**revision_data.dict(exclude={"chunks"}), item=item)
@@ -303,19 +323,30 @@ def process_revisions_for_item(item: models.CollectionItem, revision_data: Colle
             if content is not None:
                 chunk_obj = models.CollectionItemChunk(uid=uid, collection=item.collection)
                 chunk_obj.chunkFile.save("IGNORED", ContentFile(content))
-                chunk_obj.save()
             else:
                 raise ValidationError("chunk_no_content", "Tried to create a new chunk without content")
 
         chunks_objs.append(chunk_obj)
 
-    stoken = models.Stoken.objects.create()
-    revision.stoken = stoken
-    revision.save()
+    return revision, chunks_objs
+
 
-    for chunk2 in chunks_objs:
-        models.RevisionChunkRelation.objects.create(chunk=chunk2, revision=revision)
-    return revision
+def save_revisions(pending: t.List[PendingRevision]) -> t.List[models.CollectionItemRevision]:
+    """Save prepared revisions (each with a new stoken) and their chunk relations in bulk"""
+    revisions = models.CollectionItemRevision.bulk_create_with_stokens([revision for revision, _ in pending])
+    models.RevisionChunkRelation.objects.bulk_create(
+        [
+            models.RevisionChunkRelation(chunk=chunk_obj, revision=revision)
+            for revision, (_, chunks_objs) in zip(revisions, pending)
+            for chunk_obj in chunks_objs
+        ],
+        batch_size=app_settings.BULK_BATCH_SIZE,
+    )
+    return revisions
+
+
+def process_revisions_for_item(item: models.CollectionItem, revision_data: CollectionItemRevisionInOut):
+    return save_revisions([prepare_revision_for_item(item, revision_data)])[0]
 
 
 def _create(data: CollectionIn, user: UserType):
@@ -343,14 +374,16 @@ def _create(data: CollectionIn, user: UserType):
 
         collection_type_obj, _ = models.CollectionType.objects.get_or_create(uid=data.collectionType, owner=user)
 
+        stoken = models.Stoken.objects.create()
         models.CollectionMember(
             collection=instance,
-            stoken=models.Stoken.objects.create(),
+            stoken=stoken,
             user=user,
             accessLevel=models.AccessLevels.ADMIN,
             encryptionKey=data.collectionKey,
             collectionType=collection_type_obj,
         ).save()
+        models.Collection.advance_stoken(instance.pk, stoken)
 
 
 @collection_router.post("/", status_code=status.HTTP_201_CREATED, dependencies=PERMISSIONS_READWRITE)
@@ -367,8 +400,10 @@ def collection_get(
     return CollectionOut.from_orm_context(obj, Context(user, prefetch))
 
 
-def item_create(item_model: CollectionItemIn, collection: models.Collection, validate_etag: bool):
-    """Function that's called when this serializer creates an item"""
+def item_create(
+    item_model: CollectionItemIn, collection: models.Collection, validate_etag: bool
+) -> t.Optional[PendingRevision]:
+    """Create or update an item, the new revision is returned unsaved (None if up to date) to be saved in bulk"""
     etag = item_model.etag
     revision_data = item_model.content
     uid = item_model.uid
@@ -379,11 +414,13 @@ def item_create(item_model: CollectionItemIn, collection: models.Collection, val
         instance, created = Model.objects.get_or_create(
             uid=uid, collection=collection, defaults=item_model.dict(exclude={"uid", "etag", "content"})
         )
+        # Reuse the collection we already have, so new chunks don't have to fetch it for their upload path
+        instance.collection = collection
         cur_etag = instance.etag if not created else None
 
         # If we are trying to update an up to date item, abort early and consider it a success
         if cur_etag == revision_data.uid:
-            return instance
+            return None
 
         if validate_etag and cur_etag != etag:
             raise ValidationError(
@@ -398,16 +435,14 @@ def item_create(item_model: CollectionItemIn, collection: models.Collection, val
             # the race condition. But it's a good idea because it'll lock and wait rather than fail.
             current_revision = instance.revisions.filter(current=True).select_for_update()[0]
             assert current_revision is not None
-            current_revision.current = None
+            current_revision.current = False
             current_revision.save()
 
         try:
-            process_revisions_for_item(instance, revision_data)
+            return prepare_revision_for_item(instance, revision_data)
         except django_exceptions.ValidationError as e:
             transform_validation_error("content", e)
 
-    return instance
-
 
 @item_router.get("/item/{item_uid}/", response_model=CollectionItemOut, dependencies=PERMISSIONS_READ)
 def item_get(
@@ -427,6 +462,7 @@ def item_list_common(
     limit: int,
     prefetch: Prefetch,
 ) -> CollectionItemListResponse:
+    queryset = queryset.prefetch_related(models.prefetch_current_revisions())
     result, new_stoken_obj, done = filter_by_stoken_and_limit(
         stoken, limit, queryset.filter(revisions__current=True), models.CollectionItem.stoken_annotation
     )
@@ -463,27 +499,44 @@ async def item_list_subscription_ticket(
 
 def item_bulk_common(
     data: ItemBatchIn,
-    user: UserType,
+    collection: models.Collection,
     stoken: t.Optional[str],
-    uid: str,
     validate_etag: bool,
     background_tasks: BackgroundTasks,
 ):
-    queryset = get_collection_queryset(user)
+    stale_stoken_error = HttpError("stale_stoken", "Stoken is too old", status_code=status.HTTP_409_CONFLICT)
+    # Stokens only move forward, so a stoken that is already stale can be rejected without waiting for the lock
+    if stoken and stoken != collection.stoken:
+        raise stale_stoken_error
+
     with transaction.atomic():  # We need this for locking the collection object
-        collection_object = queryset.select_for_update().get(uid=uid)
+        # Access was already checked when fetching the collection, so just lock its row
+        collection_object = models.Collection.objects.select_for_update().get(pk=collection.pk)
 
         if stoken and stoken != collection_object.stoken:
-            raise HttpError("stale_stoken", "Stoken is too old", status_code=status.HTTP_409_CONFLICT)
+            raise stale_stoken_error
 
-        data.validate_db()
+        data.validate_db(collection_object)
 
         errors: t.List[HttpError] = []
+        pending: t.List[PendingRevision] = []
+        pending_uids: t.Set[str] = set()
         for item in data.items:
+            # Items (or revisions) repeating in the same batch need to see the previous ones already saved
+            if item.uid in pending_uids or item.content.uid in pending_uids:
+                save_revisions(pending)
+                pending = []
+                pending_uids.clear()
+
             try:
-                item_create(item, collection_object, validate_etag)
+                pending_revision = item_create(item, collection_object, validate_etag)
             except ValidationError as e:
                 errors.append(e)
+                continue
+
+            if pending_revision is not None:
+                pending.append(pending_revision)
+                pending_uids.update((item.uid, item.content.uid))
 
         if len(errors) > 0:
             raise ValidationError(
@@ -493,6 +546,10 @@ def item_bulk_common(
                 status_code=status.HTTP_409_CONFLICT,
             )
 
+        save_revisions(pending)
+
+        collection_object.refresh_from_db(fields=["current_stoken"])
+
     background_tasks.add_task(report_items_changed, collection_object.uid, collection_object.stoken, data.items)
 
 
@@ -515,12 +572,7 @@ def item_revisions(
         iterator_obj = get_object_or_404(queryset, uid=iterator)
         queryset = queryset.filter(id__lt=iterator_obj.id)
 
-    result = list(queryset[: limit + 1])
-    if len(result) < limit + 1:
-        done = True
-    else:
-        done = False
-        result = result[:-1]
+    result, done = paginate(queryset.prefetch_related(models.prefetch_chunks()), limit)
 
     context = Context(user, prefetch)
     ret_data = [CollectionItemRevisionInOut.from_orm_context(revision, context) for revision in result]
@@ -549,9 +601,15 @@ def fetch_updates(
 
     queryset, stoken_rev = filter_by_stoken(stoken, queryset, models.CollectionItem.stoken_annotation)
 
-    uids, etags = zip(*[(item.uid, item.etag) for item in data])
-    revs = models.CollectionItemRevision.objects.filter(uid__in=etags, current=True)
-    queryset = queryset.filter(uid__in=uids).exclude(revisions__in=revs)
+    uids = [item.uid for item in data]
+    etags = [item.etag for item in data if item.etag is not None]
+    queryset = queryset.filter(uid__in=uids)
+    # Skip the items whose current revision is already the one the client has. Only when there are etags, as an empty
+    # IN would make Django match nothing for the whole filter.
+    if etags:
+        up_to_date = models.CollectionItemRevision.objects.filter(item=OuterRef("pk"), uid__in=etags, current=True)
+        queryset = queryset.filter(~Exists(up_to_date))
+    queryset = queryset.prefetch_related(models.prefetch_current_revisions())
 
     new_stoken_obj = get_queryset_stoken(queryset)
     new_stoken = new_stoken_obj and new_stoken_obj.uid
@@ -568,24 +626,22 @@ def fetch_updates(
 
 @item_router.post("/item/transaction/", dependencies=[Depends(has_write_access), *PERMISSIONS_READWRITE])
 def item_transaction(
-    collection_uid: str,
     data: ItemBatchIn,
     background_tasks: BackgroundTasks,
     stoken: t.Optional[str] = None,
-    user: UserType = Depends(get_authenticated_user),
+    collection: models.Collection = Depends(get_collection),
 ):
-    return item_bulk_common(data, user, stoken, collection_uid, validate_etag=True, background_tasks=background_tasks)
+    return item_bulk_common(data, collection, stoken, validate_etag=True, background_tasks=background_tasks)
 
 
 @item_router.post("/item/batch/", dependencies=[Depends(has_write_access), *PERMISSIONS_READWRITE])
 def item_batch(
-    collection_uid: str,
     data: ItemBatchIn,
     background_tasks: BackgroundTasks,
     stoken: t.Optional[str] = None,
-    user: UserType = Depends(get_authenticated_user),
+    collection: models.Collection = Depends(get_collection),
 ):
-    return item_bulk_common(data, user, stoken, collection_uid, validate_etag=False, background_tasks=background_tasks)
+    return item_bulk_common(data, collection, stoken, validate_etag=False, background_tasks=background_tasks)
 
 
 # Chunks
@@ -595,7 +651,6 @@ def item_batch(
 def chunk_save(chunk_uid: str, collection: models.Collection, content_file: ContentFile):
     chunk_obj = models.CollectionItemChunk(uid=chunk_uid, collection=collection)
     chunk_obj.chunkFile.save("IGNORED", content_file)
-    chunk_obj.save()
     return chunk_obj
 
 
@@ -622,10 +677,13 @@ async def chunk_update(
     dependencies=PERMISSIONS_READ,
 )
 def chunk_download(
+    collection_uid: str,
     chunk_uid: str,
-    collection: models.Collection = Depends(get_collection),
+    user: UserType = Depends(get_authenticated_user),
 ):
-    chunk = get_object_or_404(collection.chunks, uid=chunk_uid)
+    # Check membership and find the chunk in a single query, we don't need the collection itself
+    queryset = models.CollectionItemChunk.objects.filter(collection__uid=collection_uid, collection__members__user=user)
+    chunk = get_object_or_404(queryset.only("chunkFile"), uid=chunk_uid)
 
     filename = chunk.chunkFile.path
     return sendfile(filename)
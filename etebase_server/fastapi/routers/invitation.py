@@ -13,8 +13,8 @@ from ..msgpack import MsgpackRoute
 from ..utils import (
     get_object_or_404,
     get_user_username_email_kwargs,
+    paginate,
     Context,
-    is_collection_admin,
     BaseModel,
     permission_responses,
     PERMISSIONS_READ,
@@ -103,18 +103,27 @@ def list_common(
     iterator: t.Optional[str],
     limit: int,
 ) -> InvitationListResponse:
-    queryset = queryset.order_by("id")
+    # Fetch everything the output needs in one query, without the (unused) keys and encrypted content blobs
+    queryset = (
+        queryset.select_related("user", "fromMember__user__userinfo", "fromMember__collection")
+        .only(
+            "uid",
+            "version",
+            "accessLevel",
+            "signedEncryptionKey",
+            "user__username",
+            "fromMember__user__username",
+            "fromMember__user__userinfo__pubkey",
+            "fromMember__collection__uid",
+        )
+        .order_by("id")
+    )
 
     if iterator is not None:
         iterator_obj = get_object_or_404(queryset, uid=iterator)
         queryset = queryset.filter(id__gt=iterator_obj.id)
 
-    result = list(queryset[: limit + 1])
-    if len(result) < limit + 1:
-        done = True
-    else:
-        done = False
-        result = result[:-1]
+    result, done = paginate(queryset, limit)
 
     ret_data = result
     iterator = ret_data[-1].uid if len(result) > 0 else None
@@ -171,14 +180,16 @@ def incoming_accept(
         user = invitation.user
         collection_type_obj, _ = models.CollectionType.objects.get_or_create(uid=data.collectionType, owner=user)
 
+        stoken = models.Stoken.objects.create()
         models.CollectionMember.objects.create(
             collection=invitation.collection,
-            stoken=models.Stoken.objects.create(),
+            stoken=stoken,
             user=user,
             accessLevel=invitation.accessLevel,
             encryptionKey=data.encryptionKey,
             collectionType=collection_type_obj,
         )
+        models.Collection.advance_stoken(invitation.collection.pk, stoken)
 
         models.CollectionMemberRemoved.objects.filter(user=invitation.user, collection=invitation.collection).delete()
 
@@ -198,11 +209,11 @@ def outgoing_create(
     context = Context(user, None)
     data.validate_db(context)
 
-    if not is_collection_admin(collection, user):
+    # We only need the member for the access level and as a reference, so don't load the encryption key
+    member = collection.members.only("id", "accessLevel").filter(user=user).first()
+    if member is None or member.accessLevel != models.AccessLevels.ADMIN:
         raise PermissionDenied("admin_access_required", "User is not an admin of this collection")
 
-    member = collection.members.get(user=user)
-
     with transaction.atomic():
         try:
             models.CollectionInvitation.objects.create(
@@ -239,6 +250,10 @@ def outgoing_fetch_user_profile(
     user: UserType = Depends(get_authenticated_user),
 ):
     kwargs = get_user_username_email_kwargs(username)
-    user = get_object_or_404(get_user_queryset(User.objects.all(), CallbackContext(request.path_params)), **kwargs)
-    user_info = get_object_or_404(models.UserInfo.objects.all(), owner=user)
+    user_queryset = get_user_queryset(User.objects.all(), CallbackContext(request.path_params))
+    user = get_object_or_404(user_queryset.select_related("userinfo"), **kwargs)
+    try:
+        user_info = user.userinfo
+    except models.UserInfo.DoesNotExist as e:
+        raise HttpError("does_not_exist", str(e), status_code=status.HTTP_404_NOT_FOUND)
     return UserInfoOut.from_orm(user_info)
@@ -27,7 +27,8 @@ def get_queryset(collection: models.Collection = Depends(get_collection)) -> Mem
 
 @django_db_cleanup_decorator
 def get_member(username: str, queryset: MemberQuerySet = Depends(get_queryset)) -> models.CollectionMember:
-    return get_object_or_404(queryset, user__username__iexact=username)
+    # The encryption key is never needed when modifying or removing members
+    return get_object_or_404(queryset.defer("encryptionKey"), user__username__iexact=username)
 
 
 class CollectionMemberModifyAccessLevelIn(BaseModel):
@@ -60,7 +61,8 @@ def member_list(
     limit: int = 50,
     queryset: MemberQuerySet = Depends(get_queryset),
 ):
-    queryset = queryset.order_by("id")
+    # Only fetch what's returned, the encryption keys are potentially large and aren't needed here
+    queryset = queryset.select_related("user").only("accessLevel", "user__username").order_by("id")
     result, new_stoken_obj, done = filter_by_stoken_and_limit(
         iterator, limit, queryset, models.CollectionMember.stoken_annotation
     )
@@ -96,14 +98,16 @@ def member_patch(
     with transaction.atomic():
         # We only allow updating accessLevel
         if instance.accessLevel != data.accessLevel:
-            instance.stoken = models.Stoken.objects.create()
+            stoken = models.Stoken.objects.create()
+            instance.stoken = stoken
             instance.accessLevel = data.accessLevel
             instance.save()
+            models.Collection.advance_stoken(instance.collection_id, stoken)
 
 
 @member_router.post("/member/leave/", status_code=status.HTTP_204_NO_CONTENT, dependencies=PERMISSIONS_READ)
-def member_leave(
-    user: UserType = Depends(get_authenticated_user), collection: models.Collection = Depends(get_collection)
-):
-    obj = get_object_or_404(collection.members, user=user)
+def member_leave(collection_uid: str, user: UserType = Depends(get_authenticated_user)):
+    # Looking up the user's own membership is enough, there's no need to fetch the collection first
+    queryset = default_queryset.filter(collection__uid=collection_uid).only("id", "collection_id", "user_id")
+    obj = get_object_or_404(queryset, user=user)
     obj.revoke()
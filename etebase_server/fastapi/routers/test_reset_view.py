@@ -1,12 +1,13 @@
 from django.conf import settings
 from django.db import transaction
-from django.shortcuts import get_object_or_404
 from fastapi import APIRouter, Request, status
 
+from etebase_server.django.models import UserInfo
 from etebase_server.django.utils import get_user_queryset, CallbackContext
 from .authentication import SignupIn, signup_save
 from ..msgpack import MsgpackRoute
 from ..exceptions import HttpError
+from ..utils import get_object_or_404
 from etebase_server.myauth.models import get_typed_user_model
 
 test_reset_view_router = APIRouter(route_class=MsgpackRoute, tags=["test helpers"])
@@ -21,13 +22,15 @@ def reset(data: SignupIn, request: Request):
 
     with transaction.atomic():
         user_queryset = get_user_queryset(User.objects.all(), CallbackContext(request.path_params))
+        # Only the id and the username are needed below
+        user_queryset = user_queryset.only("id", User.USERNAME_FIELD)
         user = get_object_or_404(user_queryset, username=data.user.username)
         # Only allow test users for extra safety
         if not getattr(user, User.USERNAME_FIELD).startswith("test_user"):
             raise HttpError(code="generic", detail="Endpoint not allowed for user.")
 
-        if hasattr(user, "userinfo"):
-            user.userinfo.delete()
+        # Delete directly rather than loading the userinfo just to delete it
+        UserInfo.objects.filter(owner=user).delete()
 
         signup_save(data, request)
         # Delete all of the journal data for this user for a clear test env
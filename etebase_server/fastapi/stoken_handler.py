@@ -1,3 +1,4 @@
+import functools
 import typing as t
 
 from django.db.models import QuerySet
@@ -6,15 +7,33 @@ from fastapi import status
 from etebase_server.django.models import Stoken
 
 from .exceptions import HttpError
+from .utils import paginate
 
 # TODO missing stoken_annotation type
 StokenAnnotation = t.Any
 
 
-def get_stoken_obj(stoken: t.Optional[str]) -> t.Optional[Stoken]:
+class StokenRef(t.NamedTuple):
+    id: int
+    uid: str
+
+
+# Stokens are never modified once created, so it's safe to cache them for the lifetime of the process. Only keep their
+# (immutable) id and uid rather than sharing model instances between requests.
+@functools.lru_cache(maxsize=8192)
+def get_stoken_by_uid(uid: str) -> StokenRef:
+    return StokenRef(*Stoken.objects.values_list("id", "uid").get(uid=uid))
+
+
+@functools.lru_cache(maxsize=8192)
+def get_stoken_by_id(stoken_id: int) -> StokenRef:
+    return StokenRef(*Stoken.objects.values_list("id", "uid").get(id=stoken_id))
+
+
+def get_stoken_obj(stoken: t.Optional[str]) -> t.Optional[StokenRef]:
     if stoken:
         try:
-            return Stoken.objects.get(uid=stoken)
+            return get_stoken_by_uid(stoken)
         except Stoken.DoesNotExist:
             raise HttpError("bad_stoken", "Invalid stoken.", status_code=status.HTTP_400_BAD_REQUEST)
 
@@ -23,7 +42,7 @@ def get_stoken_obj(stoken: t.Optional[str]) -> t.Optional[Stoken]:
 
 def filter_by_stoken(
     stoken: t.Optional[str], queryset: QuerySet, stoken_annotation: StokenAnnotation
-) -> t.Tuple[QuerySet, t.Optional[Stoken]]:
+) -> t.Tuple[QuerySet, t.Optional[StokenRef]]:
     stoken_rev = get_stoken_obj(stoken)
 
     queryset = queryset.annotate(max_stoken=stoken_annotation).order_by("max_stoken")
@@ -34,28 +53,20 @@ def filter_by_stoken(
     return queryset, stoken_rev
 
 
-def get_queryset_stoken(queryset: t.Iterable[t.Any]) -> t.Optional[Stoken]:
-    maxid = -1
-    for row in queryset:
-        rowmaxid = getattr(row, "max_stoken") or -1
-        maxid = max(maxid, rowmaxid)
-    new_stoken = Stoken.objects.get(id=maxid) if (maxid >= 0) else None
+def get_queryset_stoken(queryset: t.Iterable[t.Any]) -> t.Optional[StokenRef]:
+    maxid = max((row.max_stoken or -1 for row in queryset), default=-1)
+    new_stoken = get_stoken_by_id(maxid) if (maxid >= 0) else None
 
     return new_stoken or None
 
 
 def filter_by_stoken_and_limit(
     stoken: t.Optional[str], limit: int, queryset: QuerySet, stoken_annotation: StokenAnnotation
-) -> t.Tuple[list, t.Optional[Stoken], bool]:
+) -> t.Tuple[list, t.Optional[StokenRef], bool]:
 
     queryset, stoken_rev = filter_by_stoken(stoken=stoken, queryset=queryset, stoken_annotation=stoken_annotation)
 
-    result = list(queryset[: limit + 1])
-    if len(result) < limit + 1:
-        done = True
-    else:
-        done = False
-        result = result[:-1]
+    result, done = paginate(queryset, limit)
 
     new_stoken_obj = get_queryset_stoken(result) or stoken_rev
 
@@ -1,7 +1,7 @@
 import dataclasses
 import typing as t
 from typing_extensions import Literal
-import msgpack
+import msgspec
 import base64
 
 from fastapi import status, Query, Depends
@@ -45,19 +45,38 @@ def get_object_or_404(queryset: QuerySet[T], **kwargs) -> T:
         raise HttpError("does_not_exist", str(e), status_code=status.HTTP_404_NOT_FOUND)
 
 
+def paginate(queryset: QuerySet[T], limit: int) -> t.Tuple[t.List[T], bool]:
+    """Returns up to limit items of the queryset, and whether these are the last ones"""
+    # Fetch one extra item just to know whether there are more, and drop it in place
+    result = list(queryset[: limit + 1])
+    done = len(result) < limit + 1
+    if not done:
+        del result[limit:]
+    return result, done
+
+
+def get_access_level(collection, user) -> t.Optional[int]:
+    # Collections fetched through get_collection already have the access level annotated
+    if hasattr(collection, "user_access_level"):
+        return collection.user_access_level
+    return collection.members.filter(user=user).values_list("accessLevel", flat=True).first()
+
+
 def is_collection_admin(collection, user):
-    member = collection.members.filter(user=user).first()
-    return (member is not None) and (member.accessLevel == AccessLevels.ADMIN)
+    return get_access_level(collection, user) == AccessLevels.ADMIN
+
+
+# The encoder and decoder are safe to share between threads, so create them once rather than on every call
+_msgpack_encoder = msgspec.msgpack.Encoder()
+_msgpack_decoder = msgspec.msgpack.Decoder()
 
 
 def msgpack_encode(content) -> bytes:
-    ret = msgpack.packb(content, use_bin_type=True)
-    assert ret is not None
-    return ret
+    return _msgpack_encoder.encode(content)
 
 
 def msgpack_decode(content: bytes):
-    return msgpack.unpackb(content, raw=False)
+    return _msgpack_decoder.decode(content)
 
 
 def b64encode(value: bytes):
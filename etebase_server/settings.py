@@ -161,6 +161,9 @@ if any(os.path.isfile(x) for x in config_locations):
     if "redis_uri" in section:
         ETEBASE_REDIS_URI = section.get("redis_uri")
 
+    if "login_challenge_cache_seconds" in section:
+        ETEBASE_LOGIN_CHALLENGE_CACHE_SECONDS = section.getint("login_challenge_cache_seconds")
+
     if "allowed_hosts" in config:
         ALLOWED_HOSTS = [y for x, y in config.items("allowed_hosts")]
 
@@ -170,6 +173,9 @@ if any(os.path.isfile(x) for x in config_locations):
     if "database-options" in config:
         DATABASES["default"]["OPTIONS"] = config["database-options"]
 
+    if "cache" in config:
+        CACHES = {"default": {x.upper(): y for x, y in config.items("cache")}}
+
     if "ldap" in config:
         ldap = config["ldap"]
         LDAP_SERVER = ldap.get("server", "")